@@ -24,8 +24,13 @@ from sklearn.naive_bayes import GaussianNB, MultinomialNB, BernoulliNB
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.cluster import KMeans, SpectralClustering, Ward, DBSCAN
 from sklearn.decomposition import TruncatedSVD
+from sklearn.externals.joblib import Parallel, delayed, cpu_count
 import numpy as np
 import scipy as sp
+import scipy.sparse
+import collections
+import itertools
+import numbers
 import sys
 
 # A corpus is a collection of vectorized documents. To construct a corpus,
@@ -60,12 +65,40 @@ class Corpus:
     # Use 'hashingcount' as the strategy to use the `HashingVectorizer` from 
     # the Scikit library; use 'hashingtf-idf' as the strategy to use the
     # hashing strategy but to pipe the result into a Tf-Idf transformer.
+    # Use 'auto' to get 'count' for ordinary corpora but a hashing vectorizer
+    # for corpora of more than `hashing_threshold` documents, whose 
+    # vocabulary might not comfortably fit in memory. The hashed vectors keep
+    # the meaning of counts: they are neither normalized nor signed, so only
+    # hash collisions tell them apart from 'count' vectors (and feature names
+    # are not available). Options that need a vocabulary (min_df, max_df, 
+    # max_features, vocabulary, ...) keep 'auto' on 'count' whatever the 
+    # corpus size, and options that only make sense for hashing (n_features,
+    # norm, ...) are rejected, since the same call has to work at any size.
     # A set of subcorpora will be automatically generated according to the 
     # groups that were passed in; they will automatically be numbered starting
     # from 0.
+    # Set `n_jobs` to something other than 1 to vectorize the documents in 
+    # parallel (-1 uses every CPU); see PARALLEL VECTORIZING below.
+    # Vectors are stored as 32 bit integers for the 'count' strategy and as
+    # 32 bit floats otherwise, which halves the memory traffic of every 
+    # later computation compared to 64 bit floats; pass `dtype` to override.
+    # When the documents are strings (input = 'content'), set 
+    # `sort_documents` to vectorize them from shortest to longest, which can
+    # speed up vectorizing large corpora of very uneven document lengths.
     def __init__(self, groups, strategy = 'count', input = 'filename', 
-                 **kwargs):
-        all_groups = sum(groups, [])
+                 n_jobs = 1, hashing_threshold = 1000000, dtype = None, 
+                 sort_documents = False, **kwargs):
+        # The documents are streamed to the vectorizer straight out of the 
+        # groups rather than being copied into one flat list first; the group
+        # lengths are all we need to lay out the subcorpora afterwards.
+        lengths = [len(group) for group in groups]
+        all_groups = itertools.chain.from_iterable(groups)
+        if strategy == 'auto':
+            strategy = _auto_strategy(sum(lengths), hashing_threshold, kwargs)
+            if strategy == 'hashingcount':
+                kwargs = dict(kwargs, **_hashing_count_params())
+        if dtype is None:
+            dtype = np.int32 if strategy == 'count' else np.float32
         # ======= VECTORIZING =======
         # We vectorize by using the vectorizer utility classes provided in 
         # Scikit. We use all the default keyword arguments for these vectorizers
@@ -73,24 +106,90 @@ class Corpus:
         # be passed directly to these constructors.
         if strategy == 'count':
             self.feature_names_available = True
-            self.vectorizer = CountVectorizer(input = input, dtype = np.float64,
+            self.vectorizer = CountVectorizer(input = input, dtype = dtype,
                                               **kwargs)
         elif strategy == 'hashingcount' or strategy == 'hashingtf-idf':
             self.feature_names_available = False
             self.feature_names_unavailable_reason = "hashing vectorization"
-            self.vectorizer = HashingVectorizer(input = input, 
-                                                dtype = np.float64, **kwargs)
+            self.vectorizer = HashingVectorizer(input = input, dtype = dtype,
+                                                **kwargs)
         elif strategy == 'tf-idf':
             self.feature_names_available = True
-            self.vectorizer = TfidfVectorizer(input = input, dtype = np.float64,
+            self.vectorizer = TfidfVectorizer(input = input, dtype = dtype,
                                               **kwargs)
         else:
-            raise RuntimeError, 'Unrecognized vectorization strategy ' + \
-                strategy
-        self.vecs = self.vectorizer.fit_transform(all_groups)
+            raise RuntimeError('Unrecognized vectorization strategy ' + 
+                               strategy)
+        # The list of feature names is built lazily by features() and kept
+        # around, since the vectorizer re-sorts its whole vocabulary on 
+        # every call to get_feature_names(). features() hands out copies of 
+        # it, so callers are free to modify what they get back.
+        self.feature_names = None
+        # When the corpus applies tf-idf weights itself rather than leaving 
+        # them to the vectorizer (hashingtf-idf, and tf-idf vectorized in 
+        # parallel), the fitted TfidfTransformer is kept here, and 
+        # self.vectorizer only produces the counts it was fitted on; new 
+        # documents are vectorized the same way as the corpus with 
+        # self.tfidf.transform(self.vectorizer.transform(docs)). Otherwise
+        # this is None and self.vectorizer.transform(docs) does it all.
+        self.tfidf = None
+        # ======= PARALLEL VECTORIZING =======
+        # Scikit's vectorizers fit in a single thread. When `n_jobs` is not 1,
+        # the documents are split into one evenly sized shard per worker and
+        # each shard is vectorized in a separate process. The hashing 
+        # vectorizer is stateless, so its shards are simply stacked back 
+        # together. For the other strategies, each shard is counted by its 
+        # own CountVectorizer, after which the local vocabularies are merged
+        # and the shard matrices are stacked (see _merge_count_shards). 
+        # Tf-idf weights are applied to the merged counts so that they are
+        # still computed over the whole corpus, which leaves self.vectorizer 
+        # as a CountVectorizer with the merged vocabulary and the weights in
+        # self.tfidf (see above). Open file objects can't be sent to other 
+        # processes, and document frequency pruning (min_df, max_df, 
+        # max_features) or a fixed vocabulary need to see the whole corpus 
+        # at once, so those cases are always vectorized serially.
+        parallel = n_jobs != 1 and input != 'file' and sum(lengths) > 1
+        if parallel:
+            all_groups = list(all_groups)
+        if parallel and strategy in ('hashingcount', 'hashingtf-idf'):
+            blocks = Parallel(n_jobs = n_jobs)(
+                delayed(_transform_shard)(self.vectorizer, shard)
+                for shard in _split_shards(all_groups, n_jobs))
+            self.vecs = sp.sparse.vstack(blocks, format = 'csr')
+        elif parallel and strategy in ('count', 'tf-idf') and \
+                _shardable(self.vectorizer):
+            count_keys = CountVectorizer().get_params()
+            count_params = dict((k, v) for k, v in 
+                                self.vectorizer.get_params().items()
+                                if k in count_keys)
+            partials = Parallel(n_jobs = n_jobs)(
+                delayed(_count_shard)(count_params, shard) 
+                for shard in _split_shards(all_groups, n_jobs))
+            if strategy == 'tf-idf':
+                self.tfidf = TfidfTransformer(
+                    norm = self.vectorizer.norm, 
+                    use_idf = self.vectorizer.use_idf,
+                    smooth_idf = self.vectorizer.smooth_idf,
+                    sublinear_tf = self.vectorizer.sublinear_tf)
+            self.vectorizer = CountVectorizer(**count_params)
+            self.vectorizer.vocabulary_, self.vecs = \
+                _merge_count_shards(partials)
+            if strategy == 'tf-idf':
+                self.vecs = self.tfidf.fit_transform(self.vecs)
+        elif sort_documents and input == 'content':
+            # Vectorizing documents in order of length keeps documents with
+            # similar working sets in the vocabulary together; the rows are
+            # put back in their original order afterwards.
+            docs = list(all_groups)
+            order = np.argsort([len(doc) for doc in docs], kind = 'mergesort')
+            self.vecs = self.vectorizer.fit_transform([docs[i] for i in order])
+            self.vecs = self.vecs.tocsr()[np.argsort(order)]
+        else:
+            self.vecs = self.vectorizer.fit_transform(all_groups)
         # Tfidf transform if we need to
         if strategy == 'hashingtf-idf':
-            self.vecs = TfidfTransformer().fit_transform(self.vecs)
+            self.tfidf = TfidfTransformer()
+            self.vecs = self.tfidf.fit_transform(self.vecs)
         # Convert to CSR if not in CSR already
         if self.vecs.format != 'csr':
             self.vecs = self.vecs.tocsr()
@@ -101,46 +200,69 @@ class Corpus:
         # subcorpora management for us. These lines of code initialize the
         # initial set of subcorpora, inferred from the input parameters.
         self.subcorpora_indices = {}
-        index = 0
-        for i, group in enumerate(groups):
-            self.subcorpora_indices[i] = np.array(range(index, 
-                                                        index + len(group)))
-            index += len(group)
+        # Row selections made by cached_subcorpus(), least recently used 
+        # first, and how many of them to keep (at least one).
+        self.subcorpus_cache = collections.OrderedDict()
+        self.subcorpus_cache_size = 2
+        # Squared norms of the rows of self.vecs, computed by row_sqnorms().
+        self.sqnorms = None
+        # The initial subcorpora are consecutive runs of rows, so their index
+        # arrays are all views into a single array of row numbers.
+        offsets = np.cumsum([0] + lengths)
+        rows = np.arange(offsets[-1], dtype = np.intp)
+        for i in range(len(lengths)):
+            self.subcorpora_indices[i] = rows[offsets[i]:offsets[i + 1]]
     def scale(self):
         # Scaling is an important part of this process: many of our algorithms
         # require our data to be scaled or otherwise standardized. We 
         # do this by scaling features to values between [0,1]. This preserves
         # zero entries in our sparse matrix which is always a desirable 
         # quality when working with this sort of data.
-        # Scaling is sort of a convoluted process because Scipy/Scikit
-        # doesn't offer a way to do this natively. We transpose the matrix, 
-        # convert it to LIL format (which isn't inefficient in this operation),
-        # and divide each row (column in the original matrix) by the row's
-        # sum before transposing and converting back to CSR. 
+        # Scipy/Scikit don't offer a way to do this natively for sparse 
+        # matrices, but it's easy enough to do by hand on the CSR arrays: 
+        # each stored value lives in the column given by the matching entry
+        # of `indices`, so dividing `data` by the column sums gathered 
+        # through `indices` divides every feature by its sum in one 
+        # vectorized pass, without ever changing the sparsity structure or
+        # the format of the matrix. Features that sum to zero are left alone.
         # However, if the matrix is not sparse, we don't have to worry about
         # this and can simply use one of Scikit's utility methods.
-        # TODO: Maybe look at profiling to ensure that this strategy really
-        # is the least expensive one.
         if self.sparse:
-            self.vecs = self.vecs.tolil()
-            self.vecs = self.vecs.transpose()
-            num_features, _ = self.vecs.shape
-            for i in range(num_features):
-                self.vecs[i] /= self.vecs[i].sum()
-            self.vecs = self.vecs.transpose()
-            self.vecs = self.vecs.tocsr()
+            # Raw counts are stored as integers, but scaled values aren't.
+            if self.vecs.dtype.kind != 'f':
+                self.vecs = self.vecs.astype(np.float32)
+            sums = np.asarray(self.vecs.sum(axis = 0)).ravel()
+            sums[sums == 0] = 1.0
+            _csr_scale_columns(self.vecs, sums)
         else:
             mms = MinMaxScaler(copy = False)
             self.vecs = mms.fit_transform(self.vecs)
+        self.clear_cache()
             
     # ===============================================
     # =========== WORKING WITH SUBCORPORA ===========
     # ===============================================
     def get_subcorpus(self, key):
         return self.vecs[self.subcorpora_indices[key]]
+    # Selecting the rows of a subcorpus copies them out of the corpus matrix.
+    # distance() tends to be called over and over on the same few subcorpora,
+    # so it reuses its selections through this method instead: the most 
+    # recently used ones are kept, up to subcorpus_cache_size of them, for as
+    # long as neither the subcorpus nor the vectors change. Keeping only a 
+    # few of them stops the cache from growing into a second copy of the 
+    # whole corpus. The matrices returned here are shared with the cache and
+    # must not be modified in place.
+    def cached_subcorpus(self, key):
+        vecs = self.subcorpus_cache.pop(key, None)
+        if vecs is None:
+            vecs = self.vecs[self.subcorpora_indices[key]]
+            if len(self.subcorpus_cache) >= self.subcorpus_cache_size:
+                self.subcorpus_cache.popitem(last = False)
+        self.subcorpus_cache[key] = vecs
+        return vecs
     def get_subcorpora(self, keys):
-        return self.vecs[reduce(lambda x, y: np.concatenate((x,y)), 
-                                [self.subcorpora_indices[key] for key in keys])]
+        return self.vecs[np.concatenate([self.subcorpora_indices[key] 
+                                         for key in keys])]
     # The input `group` is a list of 2-tuples of the following form:
     # (SUBCORPUSKEY, INDEX)
     # The input `key` parameter is the key that will be tied to this group, 
@@ -152,23 +274,40 @@ class Corpus:
     def add_subcorpus(self, key, group):
         self.subcorpora_indices[key] = \
             np.array([self.subcorpora_indices[sk][i] for sk, i in group])
+        self.subcorpus_cache.pop(key, None)
     def del_subcorpus(self, key):
         del self.subcorpora_indices[key]
+        self.subcorpus_cache.pop(key, None)
+    # The squared Euclidean norm of every row of the corpus matrix, which 
+    # parallel distance computations need on every call. They only change 
+    # with the vectors, so they are computed once and kept until then. They 
+    # are always computed in 64 bit floats (see _gram_distances).
+    def row_sqnorms(self):
+        if self.sqnorms is None:
+            self.sqnorms = _row_sqnorms(_widen(self.vecs))
+        return self.sqnorms
+    # Forget everything that was derived from the vectors. This has to be 
+    # called whenever self.vecs changes.
+    def clear_cache(self):
+        self.subcorpus_cache = collections.OrderedDict()
+        self.sqnorms = None
     # Return a list of all the subcorpus keys.
     def subcorpora_list(self):
-        return self.subcorpora_indices.keys()
+        return list(self.subcorpora_indices.keys())
     def features(self):
         if self.feature_names_available:
-            return self.vectorizer.get_feature_names()
+            if self.feature_names is None:
+                self.feature_names = self.vectorizer.get_feature_names()
+            return list(self.feature_names)
         else:
-            raise RuntimeError, "Features not available due to " + \
-                self.feature_names_unavailable_reason
+            raise RuntimeError("Features not available due to " + 
+                               self.feature_names_unavailable_reason)
     def feature_idx(self, feature):
         if self.feature_names_available:
             return self.vectorizer.vocabulary_.get(feature)
         else:
-            raise RuntimeError, "Features not available due to " + \
-                self.feature_names_unavailable_reason
+            raise RuntimeError("Features not available due to " + 
+                               self.feature_names_unavailable_reason)
     # ==================================
     # =========== ALGORITHMS ===========
     # ==================================
@@ -200,38 +339,74 @@ class Corpus:
         for command in commands:
             try:
                 if isinstance(command, str):
-                    return_values.append(getattr(self, command)())
+                    name, args, kwargs = command, [], {}
                 elif len(command) == 2:
-                    return_values.append(getattr(self, command[0])(*command[1]))
+                    name, args, kwargs = command[0], command[1], {}
                 elif len(command) == 3:
-                    return_values.append(getattr(self, 
-                                                 command[0])(*command[1],
-                                                              **command[2]))
+                    name, args, kwargs = command
                 else:
                     return (return_values, 
                             "Received invalid command " + str(command))
-            except:
+                return_values.append(getattr(self, name)(*args, **kwargs))
+            except Exception:
                 return (return_values, 
-                        "Received exception " + sys.exc_info()[1])
-        return return_values
+                        "Received exception " + str(sys.exc_info()[1]))
+        return (return_values, None)
                     
                 
     # ======= DISTANCE =======
     # X_subcorp and Y_subcorp should be subcorpus keys. Returns the distance
-    # matrix corresponding to the given parameters; this function merely
-    # calls the pairwise_distances function provided by scikit-learn.
-    def distance(self, X_subcorp = 0, Y_subcorp = None, n_jobs = -1, **kwargs):
-        X = self.get_subcorpus(X_subcorp)
-        Y = None if Y_subcorp is None else self.get_subcorpus(Y_subcorp)
-        return pairwise_distances(X = X, Y = Y, **kwargs)
+    # matrix corresponding to the given parameters; by default this function
+    # simply calls the pairwise_distances function provided by scikit-learn,
+    # serially. Pass `n_jobs` to compute in parallel (-1 meaning one worker
+    # per CPU). Cosine and (squared) Euclidean distances are then computed 
+    # directly from one matrix product (see _gram_distances), whose rows are
+    # shared out among threads that all work on the same matrices, and which
+    # reuses the cached row norms of the corpus across calls; any other 
+    # metric is handed to pairwise_distances, which starts worker processes.
+    # Serially, the Gram path only does the same work as pairwise_distances
+    # (or more, with versions of scikit-learn that multiply sparse matrices 
+    # straight into a dense result), so it is then only used for squared
+    # Euclidean distances, which pairwise_distances can't compute for sparse
+    # matrices at all.
+    def distance(self, X_subcorp = 0, Y_subcorp = None, n_jobs = 1, **kwargs):
+        X = self.cached_subcorpus(X_subcorp)
+        Y = None if Y_subcorp is None else self.cached_subcorpus(Y_subcorp)
+        metric = kwargs.get('metric', 'euclidean')
+        if (n_jobs != 1 or metric == 'sqeuclidean') and \
+                _gram_metric(metric) and set(kwargs) <= set(['metric']):
+            sqnorms = self.row_sqnorms()
+            X_sq = sqnorms[self.subcorpora_indices[X_subcorp]]
+            Y_sq = None if Y is None else \
+                sqnorms[self.subcorpora_indices[Y_subcorp]]
+            return _gram_distances(X, Y, metric, n_jobs, X_sq, Y_sq)
+        return pairwise_distances(X = X, Y = Y, n_jobs = n_jobs, **kwargs)
     # ======= CLASSIFICATION =======
     # Classify the text using the given classifier function to generate
     # the classifier. This is a utility method used by the actual user-facing
     # classifier functions and is not meant to be called by the user directly.
     def classify(self, subcorpora, classifier_fn, **kwargs):
         classifier = classifier_fn(**kwargs)
-        X = self.get_subcorpora(subcorpora)
-        y = sum([[k]*len(self.subcorpora_indices[k]) for k in subcorpora], [])
+        # The subcorpora are looked up once, for both the rows to train on
+        # and the number of labels to emit for each subcorpus.
+        indices = [self.subcorpora_indices[k] for k in subcorpora]
+        X = self.vecs[np.concatenate(indices)]
+        # Each document is labelled with the key of its subcorpus. Mixed keys,
+        # such as the initial integer subcorpora alongside a string key from
+        # add_subcorpus, are coerced to strings by numpy just as Scikit would
+        # coerce them. Only keys that numpy can't hold in a flat array (e.g.
+        # tuples) are kept as the original key objects.
+        lengths = np.fromiter((len(i) for i in indices), 
+                              dtype = np.intp, count = len(indices))
+        try:
+            labels = np.asarray(subcorpora)
+        except ValueError:
+            labels = None
+        if labels is None or labels.ndim != 1:
+            labels = np.empty(len(subcorpora), dtype = object)
+            for i, k in enumerate(subcorpora):
+                labels[i] = k
+        y = np.repeat(labels, lengths)
         classifier.fit(X = X, y = y)
         return classifier
     # Returns a KNeighborsClassifier object from the scikit-learn library.
@@ -252,7 +427,7 @@ class Corpus:
         elif name == 'bernoulli':
             classifier = BernoulliNB(**kwargs)
         else:
-            raise RuntimeError, 'Unknown Bayesian strategy ' + name
+            raise RuntimeError('Unknown Bayesian strategy ' + name)
         return self.classify(subcorpora, classifier, **kwargs)
     # Returns a decision tree classifier.
     def decision_tree(self, subcorpora, **kwargs):
@@ -283,17 +458,302 @@ class Corpus:
     # False after this method is run. If you would like to keep the original
     # vectors with their feature name mappings, make a copy of the corpus 
     # object.
-    # Keyword arguments are passed directly to the ScikitLearn TruncatedSVD
-    # constructor.
-    def LSA(self, **kwargs):
-        svd = TruncatedSVD(**kwargs)
+    # The SVD is computed with the randomized solver by default, which costs
+    # roughly O(nnz * n_components) rather than the O(nnz * min(n, m)) of 
+    # ARPACK; pass algorithm = 'arpack' to use the latter, and `n_iter` to 
+    # trade accuracy of the randomized solver for speed. Pass `random_state`
+    # to make repeated runs deterministic. Integer counts are converted to 32
+    # bit floats first, rather than letting Scikit widen them to 64 bits.
+    # Other keyword arguments are passed directly to the ScikitLearn 
+    # TruncatedSVD constructor. The TruncatedSVD object is returned.
+    def LSA(self, algorithm = 'randomized', n_iter = 5, random_state = None, 
+            **kwargs):
+        svd = TruncatedSVD(algorithm = algorithm, n_iter = n_iter, 
+                           random_state = random_state, **kwargs)
+        if self.vecs.dtype.kind != 'f':
+            self.vecs = self.vecs.astype(np.float32)
         self.vecs = svd.fit_transform(self.vecs)
+        self.sparse = False
+        self.clear_cache()
         self.feature_names_available = False
         self.feature_names_unavailable_reason = "LSA"
-        return LSA
+        return svd
 
     # TODO Add gensim support
         
+# ======= SPARSE MATRIX HELPERS =======
+# Divide each column of the CSR matrix `vecs` by the matching entry of `denom`,
+# in place. Only the stored values are touched, so the matrix keeps both its
+# format and its sparsity structure. Every sparse operation in this module 
+# relies on `vecs` being CSR (which the constructor guarantees), so anything
+# else is an error here rather than something to silently convert.
+# The reciprocals are taken once per column so that the pass over the stored
+# values is a multiplication, which is much cheaper than a division.
+def _csr_scale_columns(vecs, denom):
+    if vecs.format != 'csr':
+        raise RuntimeError('Expected a CSR matrix, not ' + vecs.format)
+    vecs.data *= (1.0 / denom)[vecs.indices]
+
+# The sparse or dense matrix `vecs` in 64 bit floats, copied only if needed.
+def _widen(vecs):
+    if vecs.dtype == np.float64:
+        return vecs
+    return vecs.astype(np.float64)
+
+# The squared Euclidean norm of each row of the sparse or dense matrix `vecs`.
+def _row_sqnorms(vecs):
+    if sp.sparse.issparse(vecs):
+        return np.asarray(vecs.multiply(vecs).sum(axis = 1)).ravel()
+    return np.einsum('ij,ij->i', vecs, vecs)
+
+# The dense matrix of dot products between the rows of X and the columns of
+# Yt, for sparse or dense X and Yt.
+def _gram(X, Yt):
+    G = X.dot(Yt)
+    if sp.sparse.issparse(G):
+        G = G.toarray()
+    return G.astype(np.float64, copy = False)
+
+# The metrics that _gram_distances knows how to compute.
+def _gram_metric(metric):
+    return metric in ('cosine', 'euclidean', 'sqeuclidean')
+
+# Cosine, Euclidean or squared Euclidean distances between the rows of the 
+# matrices X and Y, or between the rows of X if Y is None, all derived from
+# the matrix of dot products G = X * Y.T. Scipy only multiplies sparse 
+# matrices in CSR form, and would convert the CSC transpose of Y back to CSR
+# on every product, so transposes are always converted to CSR explicitly 
+# (see _transpose), once for all of Y; for dense matrices (e.g. after LSA) 
+# the transpose is just a view and each product is a BLAS call. Then
+#     cosine(x, y) = 1 - x.y / (|x| |y|)
+#     sqeuclidean(x, y) = |x|^2 + |y|^2 - 2 x.y
+# Rows of all zeros are treated the same way as scikit's pairwise_distances 
+# treats them. Everything is computed in 64 bit floats, whatever the type of
+# the vectors: integer dot products could overflow, and in 32 bit floats the
+# cancellation in |x|^2 + |y|^2 - 2 x.y leaves identical documents some 1e-3
+# apart. Y is widened along with its transpose, X one tile at a time (or 
+# once up front when Y is None). The squared row norms of X and Y can be 
+# passed in as X_sq and Y_sq when they are already known, in which case they
+# must be 64 bit floats too.
+# Every row of the result only depends on the matching row of X, so the 
+# result is filled in tiles of consecutive rows (see _gram_tiles): each tile
+# of dot products is turned into distances while it is still in cache, 
+# instead of streaming the whole matrix through memory once per step. When Y
+# is None the result is symmetric, so each tile only computes its block on 
+# and above the diagonal and mirrors it below (see _gram_symmetric_block), 
+# which halves both the products and the conversion to distances. For 
+# sparse matrices the tiles are shared out among `n_jobs` threads (scipy 
+# releases the GIL while multiplying), each writing straight into its own 
+# part of the result. Dense tiles are computed one after the other, since 
+# BLAS already runs each of them on every core.
+def _gram_distances(X, Y, metric, n_jobs = 1, X_sq = None, Y_sq = None):
+    symmetric = Y is None
+    if symmetric:
+        X = _widen(X)
+        Y = X
+    X_norms = _row_sqnorms(_widen(X)) if X_sq is None else X_sq
+    if symmetric:
+        Y_norms = X_norms
+    else:
+        Y_norms = _row_sqnorms(_widen(Y)) if Y_sq is None else Y_sq
+    if metric == 'cosine':
+        X_norms = _cosine_norms(X_norms)
+        Y_norms = X_norms if symmetric else _cosine_norms(Y_norms)
+    D = np.empty((X.shape[0], Y.shape[0]))
+    if symmetric and sp.sparse.issparse(X):
+        tiles = _gram_tiles(X.shape[0], Y.shape[0], max_tiles = 8)
+    else:
+        tiles = _gram_tiles(X.shape[0], Y.shape[0])
+    if symmetric:
+        block, args = _gram_symmetric_block, (X, X_norms, metric, D)
+    else:
+        block = _gram_block
+        args = (X, _transpose(Y), X_norms, Y_norms, metric, D)
+    if n_jobs == 1 or not sp.sparse.issparse(X):
+        for start, stop in tiles:
+            block(*(args + (start, stop)))
+    else:
+        Parallel(n_jobs = n_jobs, backend = 'threading')(
+            delayed(block)(*(args + (start, stop))) for start, stop in tiles)
+    if symmetric:
+        np.fill_diagonal(D, 0.0)
+    return D
+
+# Split `n_rows` rows of a distance matrix with `n_cols` columns into tiles of
+# consecutive rows, as (start, stop) pairs. A tile holds about 256KB of 
+# doubles, so that it fits in the L2 cache of most processors, but at least 
+# 64 rows, below which the matrix products themselves get inefficient. Pass
+# `max_tiles` to make the tiles larger when there is a cost per tile that 
+# outweighs keeping them in cache.
+def _gram_tiles(n_rows, n_cols, max_tiles = None):
+    tile_rows = max(2**15 // max(n_cols, 1), 64)
+    if max_tiles is not None:
+        tile_rows = max(tile_rows, -(-n_rows // max_tiles))
+    return [(start, min(start + tile_rows, n_rows)) 
+            for start in range(0, n_rows, tile_rows)]
+
+# The row norms that cosine distances divide by, given the squared row norms.
+# Rows of all zeros get a norm of 1 so that they do not divide by zero.
+def _cosine_norms(sqnorms):
+    norms = np.sqrt(sqnorms)
+    norms[norms == 0] = 1.0
+    return norms
+
+# The transpose of the sparse or dense matrix `vecs` in 64 bit floats, ready
+# to be the right hand side of _gram: CSR if `vecs` is sparse.
+def _transpose(vecs):
+    if sp.sparse.issparse(vecs):
+        return _widen(vecs.T.tocsr())
+    return _widen(vecs).T
+
+# The rows of `vecs` from `start` on. For a CSR matrix this is a view that 
+# shares the stored values and column indices of `vecs` rather than the copy
+# that slicing would make, since the rows left after every tile of a 
+# symmetric distance matrix would otherwise be copied over and over.
+def _rows_from(vecs, start):
+    if not sp.sparse.issparse(vecs):
+        return vecs[start:]
+    offset = vecs.indptr[start]
+    return sp.sparse.csr_matrix(
+        (vecs.data[offset:], vecs.indices[offset:], 
+         vecs.indptr[start:] - offset),
+        shape = (vecs.shape[0] - start, vecs.shape[1]))
+
+# Turn the dot products G between rows with the norms `X_norms` and rows with
+# the norms `Y_norms` into distances, in place. The norms are the row norms 
+# for cosine distances and the squared row norms otherwise.
+def _gram_to_distances(G, X_norms, Y_norms, metric):
+    if metric == 'cosine':
+        G /= X_norms[:, np.newaxis]
+        G /= Y_norms[np.newaxis, :]
+        np.subtract(1.0, G, out = G)
+        np.clip(G, 0.0, 2.0, out = G)
+    else:
+        G *= -2.0
+        G += X_norms[:, np.newaxis]
+        G += Y_norms[np.newaxis, :]
+        np.maximum(G, 0.0, out = G)
+        if metric == 'euclidean':
+            np.sqrt(G, out = G)
+
+# Fill rows `start` to `stop` of the distance matrix `out` (see 
+# _gram_distances), where `Yt` is the transpose of Y (see _transpose).
+def _gram_block(X, Yt, X_norms, Y_norms, metric, out, start, stop):
+    G = out[start:stop]
+    G[...] = _gram(_widen(X[start:stop]), Yt)
+    _gram_to_distances(G, X_norms[start:stop], Y_norms, metric)
+
+# Fill the part of the symmetric distance matrix `out` between the rows of X
+# that belongs to rows `start` to `stop`: the distances from each row of the
+# tile to every row from `start` on are computed once, into the tile's rows,
+# and mirrored into the matching columns. No two tiles touch the same 
+# entries, so they can be filled in parallel. The rows from `start` on have
+# to be transposed for every tile, which is why sparse matrices are split 
+# into few, large tiles here (see _gram_distances).
+def _gram_symmetric_block(X, norms, metric, out, start, stop):
+    G = _gram(X[start:stop], _transpose(_rows_from(X, start)))
+    _gram_to_distances(G, norms[start:stop], norms[start:], metric)
+    out[start:stop, start:] = G
+    out[start:, start:stop] = G.T
+
+# ======= VECTORIZING HELPERS =======
+# Resolve strategy = 'auto' for a corpus of `n_docs` documents and the extra
+# vectorizer options `kwargs` (see the constructor).
+def _auto_strategy(n_docs, hashing_threshold, kwargs):
+    count_keys = set(CountVectorizer().get_params())
+    hashing_keys = set(HashingVectorizer().get_params())
+    hashing_only = sorted(set(kwargs) & (hashing_keys - count_keys))
+    if hashing_only:
+        raise RuntimeError("The 'auto' strategy doesn't accept " + 
+                           ', '.join(hashing_only))
+    if n_docs > hashing_threshold and set(kwargs) <= hashing_keys:
+        return 'hashingcount'
+    return 'count'
+
+# The HashingVectorizer options that make it produce plain counts rather than
+# normalized, signed values. Newer versions of Scikit turn the signs off with
+# `alternate_sign`, older ones with `non_negative`.
+def _hashing_count_params():
+    if 'alternate_sign' in HashingVectorizer().get_params():
+        return { 'norm' : None, 'alternate_sign' : False }
+    return { 'norm' : None, 'non_negative' : True }
+
+# ======= PARALLEL VECTORIZING HELPERS =======
+# These live at module level so that they can be shipped to worker processes.
+
+# Split `docs` into contiguous, evenly sized shards, one per worker. `n_jobs`
+# follows the joblib convention, where -1 means one worker per CPU, -2 one 
+# worker per CPU but one, and so on.
+def _split_shards(docs, n_jobs):
+    if n_jobs < 0:
+        n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+    n_shards = max(min(n_jobs, len(docs)), 1)
+    bounds = np.linspace(0, len(docs), n_shards + 1).astype(np.intp)
+    return [docs[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+# Vectorize one shard of documents with an already configured stateless 
+# vectorizer (i.e. a HashingVectorizer).
+def _transform_shard(vectorizer, docs):
+    return vectorizer.transform(docs)
+
+# A vectorizer can be fit shard by shard only if its vocabulary doesn't depend
+# on document frequencies across the whole corpus. The types of min_df and 
+# max_df matter as much as their values: an integer is a number of documents
+# and a float a proportion of them, so only an integer min_df of 1 and a 
+# float max_df of 1.0 mean that nothing is pruned (max_df = 1, for instance,
+# keeps only the terms that occur in a single document).
+def _shardable(vectorizer):
+    return vectorizer.vocabulary is None and \
+        vectorizer.max_features is None and \
+        isinstance(vectorizer.min_df, numbers.Integral) and \
+        vectorizer.min_df == 1 and \
+        isinstance(vectorizer.max_df, float) and vectorizer.max_df == 1.0
+
+# Count one shard of documents, returning the shard's own vocabulary along
+# with its count matrix. A shard can easily end up with nothing but empty or
+# stop word only documents, which Scikit refuses to fit; such a shard simply
+# contributes an empty vocabulary and rows of zeros, and whether the corpus 
+# as a whole has any terms is left to _merge_count_shards to decide.
+def _count_shard(params, docs):
+    vectorizer = CountVectorizer(**params)
+    try:
+        vecs = vectorizer.fit_transform(docs)
+    except ValueError:
+        if 'empty vocabulary' not in str(sys.exc_info()[1]):
+            raise
+        return ({}, sp.sparse.csr_matrix((len(docs), 0), 
+                                         dtype = vectorizer.dtype))
+    return (vectorizer.vocabulary_, vecs)
+
+# Merge the (vocabulary, matrix) pairs returned by _count_shard into a single
+# vocabulary and a single CSR matrix, with rows in shard order. Terms are 
+# numbered in sorted order, the same as CountVectorizer does; since every 
+# local vocabulary is sorted too, remapping a row's column indices keeps them
+# sorted. If no shard found any terms at all, this raises the same error that
+# fitting the whole corpus at once would have.
+def _merge_count_shards(partials):
+    terms = sorted(set(itertools.chain.from_iterable(
+        vocabulary for vocabulary, _ in partials)))
+    if not terms:
+        raise ValueError('empty vocabulary; perhaps the documents only '
+                         'contain stop words')
+    vocabulary = dict(zip(terms, itertools.count()))
+    blocks = []
+    for local_vocabulary, vecs in partials:
+        # Translate the shard's terms to global ids with one C-level map over
+        # the vocabulary rather than a Python loop of lookups and stores.
+        local_terms = list(local_vocabulary.keys())
+        local_ids = list(local_vocabulary.values())
+        mapping = np.empty(len(local_ids), dtype = np.intp)
+        mapping[np.array(local_ids, dtype = np.intp)] = \
+            np.fromiter(map(vocabulary.__getitem__, local_terms), 
+                        dtype = np.intp, count = len(local_terms))
+        vecs = vecs.tocsr()
+        blocks.append(sp.sparse.csr_matrix(
+            (vecs.data, mapping[vecs.indices], vecs.indptr),
+            shape = (vecs.shape[0], len(terms))))
+    return (vocabulary, sp.sparse.vstack(blocks, format = 'csr'))
+
 
 # Convert a list of files to a corpus with one subcorpus.
 def from_files(fs, **kwargs):
@@ -317,5 +777,5 @@ def from_filename_lists(fnss, **kwargs):
     return Corpus(fnss, **kwargs)
 
 # Convert a list of lists of strings to a corpus.
-def from_string_lists(sss, *kwargs):
+def from_string_lists(sss, **kwargs):
     return Corpus(sss, input = 'content', **kwargs)